@@ -1,8 +1,39 @@
+import base64
+import json
 import functions_framework
+from flask import Response
 from google import genai
-from google.genai.types import HttpOptions
+from google.genai.types import GenerateContentConfig, HttpOptions
+from google.cloud import pubsub_v1
+from pydantic import BaseModel
 import os
 
+# Optional Pub/Sub topic (full path, e.g. projects/<p>/topics/<t>). When set,
+# hello_http enqueues the URL and returns 202 immediately instead of holding
+# the ingress connection open for a minutes-long generation; a push
+# subscription pointing at process_push does the actual work. When unset, the
+# function processes synchronously as before.
+PUBSUB_TOPIC = os.environ.get("PUBSUB_TOPIC", "")
+
+_publisher = None
+
+def _get_publisher():
+    global _publisher
+    if _publisher is None:
+        _publisher = pubsub_v1.PublisherClient()
+    return _publisher
+
+# Reuse a single Gemini client across invocations. Cloud Run keeps container
+# instances warm between requests, so credential discovery and TLS setup only
+# happen once per instance instead of once per request.
+_client = None
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = genai.Client(vertexai=True,project='<<YOUR_PROJECT_ID>>',location='us-central1',http_options=HttpOptions(api_version="v1"))
+    return _client
+
 # Prompt for Gemini API
 # This prompt is critical for structuring the output.
 # We ask for a JSON string for easier programmatic parsing.
@@ -11,7 +42,7 @@ In the video at the following URL: {youtube_url}, which is a hands-on lab sessio
 Ignore the credits set-up part particularly the coupon code and credits link aspect should not be included in your analysis or the extaction of context. Also exclude any credentials that are explicit in the video.
 Take only the first 30-40 minutes of the video without throwing any error.
 Analyze the rest of the content of the video.
-Extract and synthesize information to create a book chapter section with the following structure, formatted as a JSON string:
+Extract and synthesize information to create a book chapter section with the following structure:
 1. **chapter_title:** A concise and engaging title for the chapter.
 2. **introduction_context:** Briefly explain the relevance of this video segment within a broader learning context.
 3. **what_will_build:** Clearly state the specific task or goal accomplished in this video segment.
@@ -21,23 +52,38 @@ Extract and synthesize information to create a book chapter section with the fol
 7. **demo_url:** Provide a URL to a demo if mentioned or implied. If not available, use "N/A".
 8. **qa_segment:** Generate 10–15 relevant questions based on the content of this segment, along with concise answers. Ensure the questions are thought-provoking and test understanding of the material.
 REMEMBER: Ignore the credits set-up part particularly the coupon code and credits link aspect should not be included in your analysis or the extaction of context. Also exclude any credentials that are explicit in the video.
-Example structure:
-```json
-{{
-  "chapter_title": "...",
-  "introduction_context": "...",
-  "what_will_build": "...",
-  "technologies_and_services": ["...", "..."],
-  "how_we_did_it": ["1. ...", "2. ..."],
-  "source_code_url": "...",
-  "demo_url": "...",
-  "qa_segment": [
-    {{"question": "...", "answer": "..."}},
-    ...
-  ]
-}}
 """
 
+# Split once at import time: only the URL varies per request, so formatting is
+# a cheap concat instead of re-running str.format's parser on the whole
+# template.
+_PROMPT_PREFIX, _PROMPT_SUFFIX = PROMPT_TEMPLATE.split("{youtube_url}", 1)
+
+
+# Response schema handed to Gemini so the model returns validated JSON for
+# these 8 fields directly — no markdown fences to strip, no example JSON block
+# inflating the prompt.
+class QAItem(BaseModel):
+    question: str
+    answer: str
+
+
+class ChapterSection(BaseModel):
+    chapter_title: str
+    introduction_context: str
+    what_will_build: str
+    technologies_and_services: list[str]
+    how_we_did_it: list[str]
+    source_code_url: str
+    demo_url: str
+    qa_segment: list[QAItem]
+
+
+GENERATION_CONFIG = GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=ChapterSection,
+)
+
 @functions_framework.http
 def hello_http(request):
     """HTTP Cloud Function.
@@ -59,32 +105,56 @@ def hello_http(request):
     else:
         name = 'World'
     video_url_to_process = name
+
+    # With a topic configured, hand the work to Pub/Sub and free the ingress
+    # request slot in milliseconds rather than minutes.
+    if PUBSUB_TOPIC:
+        payload = json.dumps({"url": video_url_to_process}).encode()
+        _get_publisher().publish(PUBSUB_TOPIC, payload).result()
+        return ("accepted", 202)
+
     # Ensure the necessary configurations are present
-    #process_videos_batch(video_url_to_process, PROMPT_TEMPLATE)
-    return process_videos_batch(video_url_to_process, PROMPT_TEMPLATE)
+    #process_videos_batch(video_url_to_process)
+    return process_videos_batch(video_url_to_process)
+
+
+@functions_framework.http
+def process_push(request):
+    """HTTP entry point for the Pub/Sub push subscription.
+    Decodes the pushed message and runs the actual generation; deploy this as
+    the subscription's endpoint when PUBSUB_TOPIC is configured on hello_http.
+    """
+    envelope = request.get_json(silent=True)
+    if not envelope or 'message' not in envelope:
+        return ("bad request: expected a Pub/Sub push envelope", 400)
+
+    data = base64.b64decode(envelope['message'].get('data', '')).decode('utf-8')
+    video_url_to_process = json.loads(data)['url']
+    return process_videos_batch(video_url_to_process)
 
 
 
-def process_videos_batch(video_url: str, PROMPT_TEMPLATE: str) -> str:
+def process_videos_batch(video_url: str) -> Response:
     """
-    Processes a video URL, generates chapter content using Gemini, and saves it to GCS.
+    Processes a video URL and streams the generated chapter content back as
+    Gemini produces it, so the caller starts receiving bytes while the model
+    is still generating instead of waiting for the full response.
     """
-    formatted_prompt = PROMPT_TEMPLATE.format(youtube_url=video_url)
-    try:
-
-        client = genai.Client(vertexai=True,project='<<YOUR_PROJECT_ID>>',location='us-central1',http_options=HttpOptions(api_version="v1"))
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=formatted_prompt,
-        )
-        print(response.text)
-        # In a real Cloud Function, you'd likely return this processed data
-        # or store it. For now, we just print.
-        # return response.text # Example of returning processed data
-    except Exception as e:
-        print(f"An error occurred during content generation: {e}")
-        # Handle the error appropriately, perhaps return an error message to the client
-        return f"Error processing video: {e}"
-    # Print the extracted context
-    print(response.text)
-    return response.text
+    formatted_prompt = _PROMPT_PREFIX + video_url + _PROMPT_SUFFIX
+
+    def generate():
+        try:
+            client = _get_client()
+            for chunk in client.models.generate_content_stream(
+                model="gemini-2.5-flash",
+                contents=formatted_prompt,
+                config=GENERATION_CONFIG,
+            ):
+                if chunk.text:
+                    yield chunk.text
+        except Exception as e:
+            print(f"An error occurred during content generation: {e}")
+            # Handle the error appropriately, perhaps return an error message to the client
+            yield f"Error processing video: {e}"
+
+    return Response(generate(), mimetype='application/json')
@@ -1,23 +1,61 @@
 
 from google.cloud import bigquery
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types as bq_storage_types
+from google.cloud.bigquery_storage_v1 import writer
 from google.cloud.exceptions import NotFound
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
 import os
+import sys
 import logging
 import time
-from concurrent.futures import ThreadPoolExecutor, TimeoutError, Future
-import requests # For calling your existing Cloud Run service
+import hashlib
+import contextvars
+from collections import defaultdict
+from google.cloud.logging.handlers import StructuredLogHandler
+import asyncio
+import aiohttp # For calling your existing Cloud Run service
 import json
+import zstandard as zstd
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential, before_sleep_log
+import video_insights_core # Shared Gemini prompt + client for in-process generation
 
 # --- Configuration ---
 # MANDATORY: Set these as environment variables for your Cloud Run Job
 BIGQUERY_PROJECT = os.environ.get("BIGQUERY_PROJECT")
 BIGQUERY_DATASET = os.environ.get("BIGQUERY_DATASET")
 BIGQUERY_TABLE_SOURCE = os.environ.get("BIGQUERY_TABLE_SOURCE") # Table with URLs
-BIGQUERY_TABLE_TARGET = os.environ.get("BIGQUERY_TABLE_TARGET") 
+BIGQUERY_TABLE_TARGET = os.environ.get("BIGQUERY_TABLE_TARGET")
+BIGQUERY_TABLE_STAGING = os.environ.get("BIGQUERY_TABLE_STAGING", "results_stream") # Staging table for streamed results
+BIGQUERY_TABLE_CACHE = os.environ.get("BIGQUERY_TABLE_CACHE", "") # Optional cache table; empty disables caching
 
-# !!! IMPORTANT !!! Replace this with your endpoint
-# The URL of your *existing* Cloud Run service that processes single URLs.
-URL_PROCESSOR_SERVICE_URL = os.environ.get("URL_PROCESSOR_SERVICE_URL", "https://python-video-context-YOUR_PROJECT_NUMBER.us-central1.run.app")
+# Optional: the URL of a Cloud Run service that processes single URLs.
+# When unset, the job calls Gemini directly in-process (see
+# video_insights_core), which skips an HTTP round-trip and a second billable
+# container per URL. Set this only if you need to keep the separate service.
+URL_PROCESSOR_SERVICE_URL = os.environ.get("URL_PROCESSOR_SERVICE_URL", "")
+
+URL_PROCESSOR_TIMEOUT_SECONDS = 600 # Per-URL bound, whether processed remotely or in-process
+
+# How long to wait for DNS/TCP/TLS setup, separately from the total call
+# timeout: a hung handshake should fail in seconds (and be retried) rather
+# than hold a concurrency slot for the full 600s.
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get("CONNECT_TIMEOUT", "5"))
+
+# --- Configuration for Batching and Concurrency ---
+# Both knobs are env-tunable so the throughput/latency knee can be found with
+# a sweep (e.g. concurrency in {4,8,16,24,32,48} x batch size in {10,50,100})
+# without rebuilding the image. Defaults reflect the current best guess.
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "50")) # How many URLs to claim from BQ per job instance
+MAX_CONCURRENT_TASKS_PER_INSTANCE = int(os.environ.get("MAX_CONCURRENT_TASKS_PER_INSTANCE", "24")) # How many parallel calls to the URL_PROCESSOR_SERVICE from one job instance
+
+# --- Concurrency control ---
+# The workload is entirely network-bound, so the fan-out runs on a single
+# asyncio event loop instead of a thread pool: pending calls cost a few KB
+# each rather than a thread stack, and the shared aiohttp session keeps pooled
+# HTTPS connections warm. This semaphore bounds how many calls to the URL
+# processor are in flight at once.
+_CONCURRENCY_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_TASKS_PER_INSTANCE)
 
 # --- Initialize Clients ---
 try:
@@ -27,176 +65,526 @@ except Exception as e:
     logging.error(f"Failed to initialize BigQuery client: {e}")
     raise
 
-if not URL_PROCESSOR_SERVICE_URL:
-    logging.error("URL_PROCESSOR_SERVICE_URL is not set. Cannot proceed.")
-    raise ValueError("URL_PROCESSOR_SERVICE_URL must be set.")
+# --- Idempotency cache ---
+# Cloud Run may retry a failed job execution, re-processing URLs that already
+# cost a minutes-long Gemini analysis. When BIGQUERY_TABLE_CACHE is set, each
+# generated context is remembered under sha256(url + prompt), so a retry (or a
+# duplicate URL in a later batch) is a ~50ms lookup instead of a re-generation.
+# Bound the table size with partition expiration on generated_at.
 
+def _cache_key(url: str) -> str:
+    return hashlib.sha256((url + video_insights_core.PROMPT_TEMPLATE).encode("utf-8")).hexdigest()
 
-# --- Your Function to Call Another Service ---
-def call_url_processor_service(url: str) -> str:
+
+def lookup_cached_context(key):
+    """Returns the cached context text for key, or None on miss/disabled/error."""
+    if not BIGQUERY_TABLE_CACHE:
+        return None
+
+    cache_query = f"""
+        SELECT context
+        FROM `{BIGQUERY_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE_CACHE}`
+        WHERE key = @key
+        ORDER BY generated_at DESC
+        LIMIT 1
     """
-    Calls the external Cloud Run service to process a single URL.
-    Returns the text response from the service.
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("key", "STRING", value=key)]
+    )
+    try:
+        rows = list(bq_client.query(cache_query, job_config=job_config).result())
+        return rows[0].context if rows else None
+    except Exception as e:
+        # A broken cache should never fail the batch; fall through to generation.
+        logging.warning(f"Cache lookup failed for key {key}: {e}")
+        return None
+
+
+# Cache entries generated during the current batch. The event loop is
+# single-threaded, so plain list appends need no locking; the buffer is
+# flushed in one Storage Write API append at the end of the batch instead of
+# opening a stream per URL.
+_cache_rows_buffer = []
+
+def store_cached_context(key, context):
+    """Buffers a generated context for the cache table; see flush_cache_buffer."""
+    if not BIGQUERY_TABLE_CACHE:
+        return
+    _cache_rows_buffer.append(
+        _CacheRow(key=key, context=context, generated_at=int(time.time() * 1_000_000))
+    )
+
+
+def flush_cache_buffer():
+    """Appends all buffered cache entries in one call. Best-effort."""
+    if not _cache_rows_buffer:
+        return
+    rows = list(_cache_rows_buffer)
+    _cache_rows_buffer.clear()
+    try:
+        _append_rows(BIGQUERY_TABLE_CACHE, rows)
+        logging.info(f"Stored {len(rows)} cache entries.")
+    except Exception as e:
+        logging.warning(f"Failed to store {len(rows)} cache entries: {e}")
+
+
+def _percentile(values, pct):
+    """Nearest-rank percentile of a list of per-call latencies (seconds)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[k]
+
+
+# --- Retry policy for transient failures ---
+# Flaky cold starts and throttling should not fail a minutes-long video
+# analysis permanently. Four attempts with jittered exponential backoff
+# (capped at 30s). A total-timeout expiry is deliberately NOT retryable:
+# each attempt carries the full 600s budget, so retrying it could pin a URL
+# for ~40 minutes. Connection failures are bounded by the 5s connect timeout
+# and throttling/5xx responses return quickly, so those retries stay cheap.
+RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+
+def _is_retryable_http_error(exc: BaseException) -> bool:
+    """Connection failures and throttling/5xx responses are retryable."""
+    # Order matters: a connect-timeout raises ServerTimeoutError, which
+    # subclasses both ClientConnectionError and asyncio.TimeoutError, and it
+    # must retry (it is bounded by the 5s connect timeout). Only a plain
+    # total-timeout expiry — not a ClientConnectionError — is non-retryable.
+    if isinstance(exc, aiohttp.ClientConnectionError):
+        return True
+    if isinstance(exc, asyncio.TimeoutError):
+        return False
+    return isinstance(exc, aiohttp.ClientResponseError) and exc.status in RETRYABLE_STATUS_CODES
+
+
+# --- Structured per-URL logging ---
+# At high concurrency, emitting several logging.info lines per URL contends on
+# the stdout lock and scatters one URL's story across interleaved records.
+# Per-URL events are buffered in a task-local list instead and flushed as a
+# single structured JSON record when the URL finishes. asyncio gives every
+# task its own context, so the ContextVar needs no locking.
+_PERF_EVENTS = contextvars.ContextVar("perf_events")
+
+def _setup_structured_logging():
+    """Routes job logs through Cloud Logging's structured JSON stdout handler."""
+    root = logging.getLogger()
+    root.addHandler(StructuredLogHandler())
+    root.setLevel(logging.INFO)
+
+
+def _record_event(event, **details):
+    """Buffers one event for the current URL's structured log record."""
+    events = _PERF_EVENTS.get(None)
+    if events is None:
+        # Outside a per-URL task (e.g. warmup); log immediately instead.
+        logging.info(f"{event}: {details}" if details else event)
+    else:
+        events.append({"event": event, "ts": time.time(), **details})
+
+
+def _flush_events(url, elapsed, failed):
+    """Emits the buffered events for one URL as a single structured record."""
+    logging.info(
+        "url_processed",
+        extra={
+            "json_fields": {
+                "url": url,
+                "elapsed_s": round(elapsed, 3),
+                "failed": failed,
+                "perf_events": _PERF_EVENTS.get([]),
+            }
+        },
+    )
+
+
+# --- Client warmup ---
+def _warmup():
+    """
+    Warms the heavy Google clients before the batch starts: one trivial
+    BigQuery query and (in direct mode) a one-token Gemini generation force
+    the lazy protobuf/gRPC imports, credential discovery, and connection
+    setup off the hot path. Failures are logged but never fatal.
     """
     try:
-        # Construct the payload for the request to your URL_PROCESSOR_SERVICE
-        # Your service expects a JSON payload with 'name' or 'url' to process.
-        # Let's assume 'name' is used to pass the URL.
-        payload = {"name": url}
-
-        headers = {'Content-Type': 'application/json'}
-
-        # Make the HTTP request to your deployed Cloud Run service
-        logging.info(f"Calling URL processor for: {url}")
-        response = requests.post(
-            URL_PROCESSOR_SERVICE_URL,
-            json=payload,
-            headers=headers,
-            timeout=600 # Set a reasonable timeout for the external service call
-        )
+        bq_client.query("SELECT 1").result()
+        logging.info("BigQuery client warmed up.")
+    except Exception as e:
+        logging.warning(f"BigQuery warmup failed: {e}")
+
+    if not URL_PROCESSOR_SERVICE_URL:
+        try:
+            video_insights_core.warmup()
+            logging.info("Gemini client warmed up.")
+        except Exception as e:
+            logging.warning(f"Gemini warmup failed: {e}")
+
+
+# --- Your Function to Call Another Service ---
+@retry(
+    stop=stop_after_attempt(4),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    retry=retry_if_exception(_is_retryable_http_error),
+    before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+    reraise=True,
+)
+async def _post_to_processor(session: aiohttp.ClientSession, url: str) -> str:
+    # Construct the payload for the request to your URL_PROCESSOR_SERVICE
+    # Your service expects a JSON payload with 'name' or 'url' to process.
+    # Let's assume 'name' is used to pass the URL.
+    payload = {"name": url}
+
+    headers = {'Content-Type': 'application/json'}
+
+    async with session.post(
+        URL_PROCESSOR_SERVICE_URL,
+        json=payload,
+        headers=headers,
+    ) as response:
         response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
-        
-        # Assuming your URL processor service returns the text directly in response.text
-        return response.text
 
-    except requests.exceptions.Timeout:
-        logging.error(f"Timeout calling URL processor for {url}.")
+        # Assuming your URL processor service returns the text directly in the body
+        return await response.text()
+
+
+async def call_url_processor_service(session: aiohttp.ClientSession, url: str) -> str:
+    """
+    Calls the external Cloud Run service to process a single URL, retrying
+    transient failures. Returns the text response from the service.
+    """
+    try:
+        # Make the HTTP request to your deployed Cloud Run service, holding a
+        # semaphore slot so at most MAX_CONCURRENT_TASKS_PER_INSTANCE calls
+        # are in flight at once (retries included).
+        async with _CONCURRENCY_SEMAPHORE:
+            _record_event("call_url_processor")
+            return await _post_to_processor(session, url)
+
+    except asyncio.TimeoutError:
+        _record_event("timeout")
         return f"ERROR: Timeout processing '{url}' at {URL_PROCESSOR_SERVICE_URL}"
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Request error calling URL processor for {url}: {e}")
+    except aiohttp.ClientError as e:
+        _record_event("request_error", error=str(e))
         return f"ERROR: Request failed for '{url}'. Details: {e}"
     except Exception as e:
-        logging.error(f"An unexpected error occurred calling URL processor for {url}: {e}")
+        _record_event("unexpected_error", error=str(e))
         return f"ERROR: Unexpected error for '{url}'. Details: {e}"
 
 
-# --- Helper to update a single row in BigQuery ---
-def update_bq_row(row_id, context, status="COMPLETED"):
-    """Updates a specific row in the target BigQuery table."""
+async def process_url(session: aiohttp.ClientSession, url: str) -> str:
+    """
+    Generates context for a single URL. By default Gemini is called directly
+    in-process; if URL_PROCESSOR_SERVICE_URL is configured, the external
+    Cloud Run service is used instead. Results are served from and written to
+    the idempotency cache when one is configured.
+    """
+    key = _cache_key(url)
+    cached = await asyncio.to_thread(lookup_cached_context, key)
+    if cached is not None:
+        _record_event("cache_hit")
+        return cached
+
+    if URL_PROCESSOR_SERVICE_URL:
+        content = await call_url_processor_service(session, url)
+    else:
+        try:
+            async with _CONCURRENCY_SEMAPHORE:
+                _record_event("gemini_generate")
+                # Native async call; no worker thread needed per generation.
+                # wait_for keeps one hung generation from stalling the batch.
+                content = await asyncio.wait_for(
+                    video_insights_core.generate_video_context(url),
+                    timeout=URL_PROCESSOR_TIMEOUT_SECONDS,
+                )
+        except asyncio.TimeoutError:
+            _record_event("timeout")
+            content = f"ERROR: Timeout generating context for '{url}'."
+        except Exception as e:
+            _record_event("generation_error", error=str(e))
+            content = f"ERROR: Generation failed for '{url}'. Details: {e}"
+
+    if not content.startswith("ERROR:"):
+        store_cached_context(key, content) # Just a buffer append; flushed per batch
+    return content
+
+
+# --- Result writeback via the BigQuery Storage Write API ---
+# DML UPDATEs are subject to per-table concurrent-DML quotas and multi-second
+# job overhead, so results are streamed into a staging table
+# (id STRING, context_zstd BYTES, status STRING, ts TIMESTAMP) with the
+# Storage Write API and then folded into the target table with a single MERGE.
+# The staging table must be partitioned on ts with partition expiration (see
+# the README DDL) so merged rows age out and the MERGE's GROUP BY does not
+# re-scan an unbounded append-only history.
+# Chapter JSON compresses roughly 5-10x under zstd, so contexts are stored as
+# compressed BYTES; decompress client-side when reading the target table.
+_ZSTD_COMPRESSOR = zstd.ZstdCompressor(level=6)
+
+def _build_row_class(message_name, fields):
+    """Builds a protobuf message class describing one BigQuery table row."""
+    file_proto = descriptor_pb2.FileDescriptorProto()
+    file_proto.name = f"{message_name.lower()}.proto"
+    file_proto.package = "video_context_crj"
+    msg_proto = file_proto.message_type.add()
+    msg_proto.name = message_name
+    for number, (field_name, field_type) in enumerate(fields, start=1):
+        field = msg_proto.field.add()
+        field.name = field_name
+        field.number = number
+        field.type = field_type
+        field.label = descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    descriptor = pool.FindMessageTypeByName(f"video_context_crj.{message_name}")
+    return message_factory.GetMessageClass(descriptor)
+
+_ResultRow = _build_row_class(
+    "ResultRow",
+    [
+        ("id", descriptor_pb2.FieldDescriptorProto.TYPE_STRING),
+        ("context_zstd", descriptor_pb2.FieldDescriptorProto.TYPE_BYTES),
+        ("status", descriptor_pb2.FieldDescriptorProto.TYPE_STRING),
+        ("ts", descriptor_pb2.FieldDescriptorProto.TYPE_INT64), # TIMESTAMP as epoch micros
+    ],
+)
+
+_CacheRow = _build_row_class(
+    "CacheRow",
+    [
+        ("key", descriptor_pb2.FieldDescriptorProto.TYPE_STRING),
+        ("context", descriptor_pb2.FieldDescriptorProto.TYPE_STRING),
+        ("generated_at", descriptor_pb2.FieldDescriptorProto.TYPE_INT64), # TIMESTAMP as epoch micros
+    ],
+)
+
+
+# One write client shared by the staging and cache appends; constructing a
+# client per append would pay gRPC channel setup on every call.
+_write_client = None
+
+def _get_write_client():
+    global _write_client
+    if _write_client is None:
+        _write_client = bigquery_storage_v1.BigQueryWriteClient()
+    return _write_client
+
+
+def _append_rows(table_name, rows):
+    """Appends protobuf row messages to table_name via the default write stream."""
+    write_client = _get_write_client()
+    parent = write_client.table_path(BIGQUERY_PROJECT, BIGQUERY_DATASET, table_name)
+    stream_name = f"{parent}/_default"
+
+    proto_schema = bq_storage_types.ProtoSchema()
+    type(rows[0]).DESCRIPTOR.CopyToProto(proto_schema.proto_descriptor)
+
+    request_template = bq_storage_types.AppendRowsRequest(
+        write_stream=stream_name,
+        proto_rows=bq_storage_types.AppendRowsRequest.ProtoData(writer_schema=proto_schema),
+    )
+    append_rows_stream = writer.AppendRowsStream(write_client, request_template)
+
+    proto_rows = bq_storage_types.ProtoRows()
+    for row in rows:
+        proto_rows.serialized_rows.append(row.SerializeToString())
+
+    request = bq_storage_types.AppendRowsRequest(
+        proto_rows=bq_storage_types.AppendRowsRequest.ProtoData(rows=proto_rows)
+    )
+    append_rows_stream.send(request).result() # Wait for the append to be acknowledged
+    append_rows_stream.close()
+    return len(rows)
+
+
+def append_results_to_staging(processed_results):
+    """Streams all (id, context, status) results into the staging table.
+
+    One append on the table's default write stream replaces per-row DML jobs.
+    Returns the number of rows appended on success, 0 on failure.
+    """
+    if not processed_results:
+        return 0
+
+    try:
+        now_micros = int(time.time() * 1_000_000)
+        rows = [
+            _ResultRow(
+                id=row_id,
+                context_zstd=_ZSTD_COMPRESSOR.compress(data["context"].encode("utf-8")),
+                status=data["status"],
+                ts=now_micros,
+            )
+            for row_id, data in processed_results.items()
+        ]
+        appended = _append_rows(BIGQUERY_TABLE_STAGING, rows)
+        logging.info(f"Appended {appended} result rows to staging table '{BIGQUERY_TABLE_STAGING}'.")
+        return appended
+    except Exception as e:
+        logging.error(f"Failed to append {len(processed_results)} rows to staging table: {e}")
+        return 0
+
+
+def merge_staging_into_target():
+    """Folds the newest staged result per id into the target table with one MERGE."""
     if not BIGQUERY_TABLE_TARGET:
         logging.error("BIGQUERY_TABLE_TARGET not configured. Cannot update BigQuery.")
         return False
 
-    update_query = f"""
-        UPDATE `{BIGQUERY_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE_TARGET}`
-        SET
-            context = @context,
-            status = @status
-        WHERE id = @row_id
+    merge_query = f"""
+        MERGE `{BIGQUERY_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE_TARGET}` AS t
+        USING (
+            SELECT
+                id,
+                ARRAY_AGG(context_zstd ORDER BY ts DESC LIMIT 1)[OFFSET(0)] AS context_zstd,
+                ARRAY_AGG(status ORDER BY ts DESC LIMIT 1)[OFFSET(0)] AS status
+            FROM `{BIGQUERY_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE_STAGING}`
+            GROUP BY id
+        ) AS s
+        ON t.id = s.id
+        WHEN MATCHED THEN
+            UPDATE SET context_zstd = s.context_zstd, status = s.status
+        WHEN NOT MATCHED THEN
+            INSERT (id, context_zstd, status) VALUES (s.id, s.context_zstd, s.status)
     """
 
-    job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("context", "STRING", value=context),
-                bigquery.ScalarQueryParameter("status", "STRING", value=status),
-                bigquery.ScalarQueryParameter("row_id", "STRING", value=row_id)
-                ]
-        )
-
     try:
-        update_job = bq_client.query(update_query, job_config=job_config)
-        update_job.result() # Wait for the job to complete
-        logging.info(f"Successfully updated BigQuery row ID {row_id} with status {status}.")
+        merge_job = bq_client.query(merge_query)
+        merge_job.result() # Wait for the job to complete
+        logging.info("Merged staging table into target table.")
         return True
     except Exception as e:
-        logging.error(f"Failed to update BigQuery row ID {row_id}: {e}")
+        logging.error(f"Failed to merge staging table into target table: {e}")
         return False
 
 # --- Main orchestrator for the Cloud Run Job ---
-def process_batch_from_bq(request_or_trigger_data=None):
+async def process_batch_from_bq(request_or_trigger_data=None):
     """
     Cloud Run Job main function to read from BigQuery, call external service in parallel, and write back.
     """
     if not BIGQUERY_TABLE_SOURCE:
         logging.error("BIGQUERY_TABLE_SOURCE not configured. Exiting.")
         return "Configuration error: BIGQUERY_TABLE_SOURCE is not set.", 500
-    if not URL_PROCESSOR_SERVICE_URL:
-        logging.error("URL_PROCESSOR_SERVICE_URL is not set. Exiting.")
-        return "Configuration error: URL_PROCESSOR_SERVICE_URL is not set.", 500
-
-    # --- Configuration for Batching and Concurrency ---
-    BATCH_SIZE = 5 # How many URLs to fetch from BQ per query in the job instance
-    MAX_CONCURRENT_TASKS_PER_INSTANCE = 5 # How many parallel calls to the URL_PROCESSOR_SERVICE from one job instance
-    URL_PROCESSOR_TIMEOUT_SECONDS = 600 # Timeout for each call to your URL processor service
 
-    # --- Step 1: Fetch batch of URLs from BigQuery ---
-    query = f"""
+    # --- Step 1: Atomically claim a batch of PENDING URLs from BigQuery ---
+    # A single scripted query marks the rows PROCESSING *and* returns them, so
+    # we pay one job launch instead of two. The select-and-update runs inside
+    # a transaction: a script alone is not atomic, and two concurrent job
+    # instances could otherwise read the same PENDING snapshot and both pay
+    # for the same URLs. On a write conflict BigQuery aborts one transaction,
+    # which surfaces as a job error and is retried by the job's retry policy.
+    # Note: query parameters are not supported in multi-statement queries, so
+    # BATCH_SIZE (an int constant) is interpolated directly.
+    source_table = f"`{BIGQUERY_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE_SOURCE}`"
+    claim_query = f"""
+        DECLARE ids ARRAY<STRING>;
+        BEGIN TRANSACTION;
+        SET ids = (
+            SELECT ARRAY_AGG(id) FROM (
+                SELECT id
+                FROM {source_table}
+                WHERE status = 'PENDING'
+                LIMIT {BATCH_SIZE}
+            )
+        );
+        UPDATE {source_table}
+        SET status = 'PROCESSING'
+        WHERE id IN UNNEST(ids);
+        COMMIT TRANSACTION;
         SELECT url, id
-        FROM `{BIGQUERY_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE_SOURCE}`
-        WHERE status = 'PENDING'
-        LIMIT {BATCH_SIZE}
+        FROM {source_table}
+        WHERE id IN UNNEST(ids);
     """
-    job_config = bigquery.QueryJobConfig()
-    print(BATCH_SIZE)
     try:
-        logging.info(f"Fetching up to {BATCH_SIZE} pending URLs from BigQuery...")
-        rows = bq_client.query(query, job_config=job_config).result()
-        
+        logging.info(f"Claiming up to {BATCH_SIZE} pending URLs from BigQuery...")
+        # The BigQuery client is blocking, so run it off the event loop.
+        rows = await asyncio.to_thread(lambda: bq_client.query(claim_query).result())
+
         pending_urls_data = []
         for row in rows:
             pending_urls_data.append({"url": row.url, "id": row.id})
-        
+
         if not pending_urls_data:
             logging.info("No pending URLs found. Job finished.")
             return "No pending URLs found. Job finished.", 200
 
-        logging.info(f"Fetched {len(pending_urls_data)} URLs for processing.")
-        
-
-        row_ids_to_process = [item["id"] for item in pending_urls_data]
-
-        # --- Step 2: Mark URLs as PROCESSING in BigQuery ---
-        update_status_query = f"""
-            UPDATE `{BIGQUERY_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE_SOURCE}`
-            SET status = 'PROCESSING'
-            WHERE id IN UNNEST(@row_ids_to_process)
-        """
-        
-        status_update_job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ArrayQueryParameter("row_ids_to_process", "STRING", values=row_ids_to_process)]
+        logging.info(f"Claimed {len(pending_urls_data)} URLs and marked them 'PROCESSING'.")
+
+        # --- Step 2: Call the external URL Processor Service concurrently ---
+        processed_results = {} # Store results by row_id: {"context": str, "status": str}
+
+        # Duplicate URLs across PENDING rows would each pay a full generation;
+        # process each unique URL once and fan the result out to every row
+        # that references it.
+        ids_by_url = defaultdict(list)
+        for item in pending_urls_data:
+            ids_by_url[item["url"]].append(item["id"])
+        if len(ids_by_url) < len(pending_urls_data):
+            logging.info(f"Deduplicated {len(pending_urls_data)} rows to {len(ids_by_url)} unique URLs.")
+
+        call_latencies = [] # Per-call wall time in seconds, for the tuning sweep
+        batch_started = time.monotonic()
+
+        async def timed_call(url):
+            _PERF_EVENTS.set([]) # Task-local buffer for this URL's events
+            call_started = time.monotonic()
+            try:
+                content = await process_url(session, url)
+            except Exception as e:
+                _record_event("unexpected_error", error=str(e))
+                content = f"ERROR: Unexpected error during result retrieval for '{url}'. Details: {e}"
+            elapsed = time.monotonic() - call_started
+            call_latencies.append(elapsed)
+            # One structured record per URL instead of several interleaved lines.
+            _flush_events(url, elapsed, failed=content.startswith("ERROR:"))
+            return url, content
+
+        timeout = aiohttp.ClientTimeout(
+            total=URL_PROCESSOR_TIMEOUT_SECONDS,
+            connect=CONNECT_TIMEOUT_SECONDS,
         )
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            # One coroutine per unique URL; the module-level semaphore bounds
+            # how many requests are actually in flight at a time. Results are
+            # recorded as each task finishes (not in submission order), so a
+            # completed response body is released immediately instead of being
+            # held until every earlier submission has finished.
+            tasks = [asyncio.ensure_future(timed_call(url)) for url in ids_by_url]
+            for completed in asyncio.as_completed(tasks):
+                url, content = await completed
+                # Check if the result itself indicates an error from the processor
+                status = "FAILED_PROCESSING" if content.startswith("ERROR:") else "COMPLETED"
+                for row_id in ids_by_url[url]:
+                    processed_results[row_id] = {"context": content, "status": status}
+            del tasks # Drop task references so finished results are collectable
 
-        
-        update_status_job = bq_client.query(update_status_query, job_config=status_update_job_config)
-        update_status_job.result()
-        logging.info(f"Marked {len(row_ids_to_process)} URLs as 'PROCESSING'.")
+        # All generations for this batch are done; write the buffered cache
+        # entries in a single append.
+        await asyncio.to_thread(flush_cache_buffer)
 
-        # --- Step 3: Call the external URL Processor Service in parallel ---
-        processed_results = {} # Store results by row_id: {"context": str, "status": str}
-        futures = []
-
-        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS_PER_INSTANCE) as executor:
-            for item in pending_urls_data:
-                url = item["url"]
-                row_id = item["id"]
-                # Submit the task to call the external service
-                future = executor.submit(call_url_processor_service, url)
-                futures.append((row_id, future))
-
-            # Process completed futures as they finish
-            for row_id, future in futures:
-                try:
-                    content = future.result(timeout=URL_PROCESSOR_TIMEOUT_SECONDS)
-                    # Check if the result itself indicates an error from the processor
-                    if content.startswith("ERROR:"):
-                        processed_results[row_id] = {"context": content, "status": "FAILED_PROCESSING"}
-                    else:
-                        processed_results[row_id] = {"context": content, "status": "COMPLETED"}
-                except TimeoutError:
-                    logging.warning(f"URL processing timed out (service call for row ID {row_id}). Marking as FAILED.")
-                    processed_results[row_id] = {"context": f"ERROR: Processing timed out for '{row_id}'.", "status": "FAILED_PROCESSING"}
-                except Exception as e:
-                    logging.error(f"Exception during future result retrieval for row ID {row_id}: {e}")
-                    processed_results[row_id] = {"context": f"ERROR: Unexpected error during result retrieval for '{row_id}'. Details: {e}", "status": "FAILED_PROCESSING"}
-
-        # --- Step 4: Write results back to BigQuery ---
+        # Per-batch latency/throughput stats so a concurrency x batch-size
+        # sweep can locate the knee from the job logs alone.
+        batch_elapsed = time.monotonic() - batch_started
+        successful_calls = sum(1 for data in processed_results.values() if data["status"] == "COMPLETED")
+        logging.info(
+            f"Batch stats: p50={_percentile(call_latencies, 50):.1f}s "
+            f"p90={_percentile(call_latencies, 90):.1f}s over {len(call_latencies)} calls, "
+            f"{successful_calls / batch_elapsed:.3f} successful URLs/s "
+            f"(BATCH_SIZE={BATCH_SIZE}, MAX_CONCURRENT_TASKS_PER_INSTANCE={MAX_CONCURRENT_TASKS_PER_INSTANCE})."
+        )
+
+        # --- Step 3: Write results back to BigQuery ---
         logging.info(f"Writing {len(processed_results)} results back to BigQuery...")
-        successful_updates = 0
-        for row_id, data in processed_results.items():
-            if update_bq_row(row_id, data["context"], data["status"]):
-                successful_updates += 1
-        
+        successful_updates = await asyncio.to_thread(append_results_to_staging, processed_results)
+        if not successful_updates:
+            # Nothing reached the staging table; source rows are stuck in
+            # 'PROCESSING'. Fail the batch so the job exits non-zero.
+            return f"Batch processing failed: could not stage {len(processed_results)} results.", 500
+        if not await asyncio.to_thread(merge_staging_into_target):
+            # Staged but never applied to the target table: the results are
+            # not visible, so this batch cannot be reported as a success.
+            return f"Batch processing failed: merge of {successful_updates} staged results into target failed.", 500
+
         logging.info(f"Finished processing. {successful_updates} out of {len(processed_results)} rows updated successfully.")
 
         return f"Batch processing complete. Processed {len(processed_results)} URLs, updated {successful_updates}.", 200
@@ -209,4 +597,13 @@ def process_batch_from_bq(request_or_trigger_data=None):
         # Raise exception for Cloud Run Jobs to handle retries if configured
         raise
 
-process_batch_from_bq()
+if __name__ == "__main__":
+    # Only run the batch when launched as the job entry point: importing this
+    # module (health checks, tests, WSGI preload) must not trigger a full
+    # BQ scan + generation fan-out. A non-zero exit code lets Cloud Run Jobs
+    # apply its configured retries.
+    _setup_structured_logging()
+    _warmup()
+    message, status_code = asyncio.run(process_batch_from_bq())
+    logging.info(message)
+    sys.exit(0 if status_code == 200 else 1)
@@ -0,0 +1,129 @@
+
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai.types import GenerateContentConfig, HttpOptions
+from pydantic import BaseModel
+import os
+import logging
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential, before_sleep_log
+
+# --- Configuration ---
+# Project/location for the Vertex AI Gemini client. Falls back to the
+# BigQuery project so a job instance normally needs no extra configuration.
+GENAI_PROJECT = os.environ.get("GOOGLE_CLOUD_PROJECT", os.environ.get("BIGQUERY_PROJECT"))
+GENAI_LOCATION = os.environ.get("GENAI_LOCATION", "us-central1")
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+
+# Prompt for Gemini API
+# Same prompt as Cloud_Run_Function/generate_video_insights; kept here so the
+# batch job can generate context in-process without the extra HTTP hop.
+PROMPT_TEMPLATE = """
+In the video at the following URL: {youtube_url}, which is a hands-on lab session:
+Ignore the credits set-up part particularly the coupon code and credits link aspect should not be included in your analysis or the extaction of context. Also exclude any credentials that are explicit in the video.
+Take only the first 30-40 minutes of the video without throwing any error.
+Analyze the rest of the content of the video.
+Extract and synthesize information to create a book chapter section with the following structure:
+1. **chapter_title:** A concise and engaging title for the chapter.
+2. **introduction_context:** Briefly explain the relevance of this video segment within a broader learning context.
+3. **what_will_build:** Clearly state the specific task or goal accomplished in this video segment.
+4. **technologies_and_services:** List all mentioned Google Cloud services and any other relevant technologies (e.g., programming languages, tools, frameworks).
+5. **how_we_did_it:** Provide a clear, numbered step-by-step guide of the actions performed. Include any exact commands or code snippets as they appear in the video. Format code/commands using markdown backticks (e.g., `my-command`).
+6. **source_code_url:** Provide a URL to the source code repository if mentioned or implied. If not available, use "N/A".
+7. **demo_url:** Provide a URL to a demo if mentioned or implied. If not available, use "N/A".
+8. **qa_segment:** Generate 10–15 relevant questions based on the content of this segment, along with concise answers. Ensure the questions are thought-provoking and test understanding of the material.
+REMEMBER: Ignore the credits set-up part particularly the coupon code and credits link aspect should not be included in your analysis or the extaction of context. Also exclude any credentials that are explicit in the video.
+"""
+
+# Only {youtube_url} varies between requests, so the template is split once at
+# import time and each call just concatenates the two halves.
+_PROMPT_PREFIX, _PROMPT_SUFFIX = PROMPT_TEMPLATE.split("{youtube_url}", 1)
+
+
+# --- Response schema ---
+# Passed to Gemini so it returns validated JSON directly instead of a
+# markdown-fenced JSON string the caller would have to strip and re-parse.
+# Mirrors the 8 fields requested in the prompt.
+class QAItem(BaseModel):
+    question: str
+    answer: str
+
+
+class ChapterSection(BaseModel):
+    chapter_title: str
+    introduction_context: str
+    what_will_build: str
+    technologies_and_services: list[str]
+    how_we_did_it: list[str]
+    source_code_url: str
+    demo_url: str
+    qa_segment: list[QAItem]
+
+
+GENERATION_CONFIG = GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=ChapterSection,
+)
+
+# Reuse a single Gemini client across calls; building one means credential
+# discovery and TLS setup, which only needs to happen once per instance.
+_client = None
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = genai.Client(vertexai=True,project=GENAI_PROJECT,location=GENAI_LOCATION,http_options=HttpOptions(api_version="v1"))
+    return _client
+
+
+# Throttling and transient server errors from Gemini are worth retrying:
+# each permanent failure wastes a minutes-long video analysis.
+RETRYABLE_GENAI_CODES = (429, 500, 502, 503, 504)
+
+def _is_retryable_genai_error(exc: BaseException) -> bool:
+    if isinstance(exc, ConnectionError):
+        return True
+    return isinstance(exc, genai_errors.APIError) and exc.code in RETRYABLE_GENAI_CODES
+
+
+def warmup():
+    """
+    Builds the Gemini client and issues a one-token generation so the first
+    real request pays no credential/TLS/lazy-import cost. Best-effort and
+    deliberately unretried — backoff here would stall container start.
+    Raises on failure; callers decide whether that is fatal.
+    """
+    _get_client().models.generate_content(
+        model=GEMINI_MODEL,
+        contents="ping",
+        config=GenerateContentConfig(max_output_tokens=1),
+    )
+
+
+@retry(
+    stop=stop_after_attempt(4),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    retry=retry_if_exception(_is_retryable_genai_error),
+    before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+    reraise=True,
+)
+async def generate_video_context(video_url: str) -> str:
+    """
+    Generates the chapter context for a single video URL with Gemini,
+    retrying transient API errors with jittered backoff.
+    Uses the client's native async surface, so callers on an event loop need
+    no worker thread per call. Raises on generation failure; the caller
+    decides how to record errors.
+    """
+    formatted_prompt = _PROMPT_PREFIX + video_url + _PROMPT_SUFFIX
+    client = _get_client()
+    # Consume the streaming variant so bytes arrive (and failures surface) as
+    # soon as the model produces them rather than after the full response.
+    chunks = []
+    async for chunk in await client.aio.models.generate_content_stream(
+        model=GEMINI_MODEL,
+        contents=formatted_prompt,
+        config=GENERATION_CONFIG,
+    ):
+        if chunk.text:
+            chunks.append(chunk.text)
+    return "".join(chunks)